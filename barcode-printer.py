@@ -21,9 +21,17 @@ def main():
         print(f"Error: Script not found at {script_path}")
         return 1
 
+    if os.name != "nt":
+        # Replace this process with the script; signals reach it directly
+        try:
+            os.execv(python_path, [python_path, script_path])
+        except OSError as e:
+            print(f"Exec error: {e}")
+            return 1
+
     process = None
     try:
-        # Launch the script
+        # Launch the script (Windows has no exec that keeps Ctrl+C handling)
         process = subprocess.Popen([python_path, script_path])
 
         # Wait for it to complete
@@ -34,10 +42,7 @@ def main():
         print("\nExecution interrupted by user (Ctrl+C).")
         if process and process.poll() is None:
             try:
-                if os.name == "nt":
-                    process.send_signal(signal.CTRL_BREAK_EVENT)
-                else:
-                    process.terminate()
+                process.send_signal(signal.CTRL_BREAK_EVENT)
             except Exception as e:
                 print(f"Error while terminating subprocess: {e}")
         return 130  # Convention: 128 + SIGINT
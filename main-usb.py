@@ -2,12 +2,18 @@ import logging
 import sqlite3
 import threading
 import time
-import json
-import os  # For detecting CPU cores
-from datetime import datetime, timedelta
+import os
+import atexit
+import queue
+from contextlib import contextmanager
+from datetime import datetime
+from functools import lru_cache
+import orjson
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-from escpos.printer import Usb
+from cheroot.wsgi import Server as WSGIServer
+from cheroot.ssl.builtin import BuiltinSSLAdapter
+from escpos.printer import Dummy, Usb
 
 app = Flask(__name__)
 CORS(app)  # Allow all origins
@@ -18,11 +24,28 @@ DEFAULT_USB_VENDOR_ID = 0x0fe6  # e.g., 0x04b8
 DEFAULT_USB_PRODUCT_ID = 0x8800  # e.g., 0x0202
 
 MAX_RETRIES = 3
-WORKER_COUNT = os.cpu_count() or 1
+# PRINT_WORKERS: number of print worker threads (default 1, for the single
+# default USB printer). Each printer is written to by one worker at a time,
+# so only raise it when jobs target several printers via usb_vendor_id /
+# usb_product_id; more workers than printers add no throughput.
+WORKER_COUNT = max(1, int(os.environ.get('PRINT_WORKERS', '1')))
 JOB_RETENTION_DAYS = 7
 
+HTTP_HOST = "0.0.0.0"
+HTTP_PORT = 8000
+HTTP_THREADS = 8  # request threads, sized independently of WORKER_COUNT
+SSL_CERT = "./certs/cert.pem"
+SSL_KEY = "./certs/cert.key"
+
+DB_READER_COUNT = 4
+DB_MMAP_SIZE = 64 * 1024 * 1024
+JOB_WAIT_TIMEOUT = 5  # seconds; safety net for rows recovered outside add_to_queue
+PREFETCH_SIZE = 2 * WORKER_COUNT  # claimed jobs buffered in memory for workers
+
 DEFAULT_BARCODE_WIDTH = 3
 DEFAULT_BARCODE_HEIGHT = 100
+USB_WRITE_TIMEOUT_MS = 2000  # pyusb timeouts are in ms; covers one chunk of copies
+COPIES_PER_WRITE = 10  # copies batched into one printer write; bounds each write's duration
 
 logging.basicConfig(
     level=logging.INFO,
@@ -41,12 +64,77 @@ sqlite3.register_adapter(datetime, adapt_datetime)
 sqlite3.register_converter("timestamp", convert_datetime)
 # -------------------------------------------------------
 
-def connect_db():
-    return sqlite3.connect(DB_PATH, detect_types=sqlite3.PARSE_DECLTYPES)
+# --- Connection pool: one shared writer, DB_READER_COUNT readers ---
+_POOL = queue.Queue()
+_pool_lock = threading.Lock()
+_pool_ready = False
+_writer_conn = None
+_writer_lock = threading.Lock()
+
+# The dispatcher sleeps on this until a job is enqueued or a worker frees
+# a prefetch slot; workers block on _in_flight instead of SQLite
+_job_cv = threading.Condition()
+_in_flight = queue.Queue(maxsize=PREFETCH_SIZE)
+_shutdown = threading.Event()
+
+
+def connect_db(read_only=False):
+    mode = "ro" if read_only else "rwc"
+    conn = sqlite3.connect(
+        f"file:{DB_PATH}?mode={mode}",
+        uri=True,
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        check_same_thread=False  # pooled connections are handed between threads
+    )
+    if not read_only:
+        # WAL is persistent in the database file, so the writer sets it once
+        conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    return conn
+
+
+def _init_pool():
+    global _writer_conn, _pool_ready
+    with _pool_lock:
+        if _pool_ready:
+            return
+        _writer_conn = connect_db()
+        for _ in range(DB_READER_COUNT):
+            _POOL.put(connect_db(read_only=True))
+        _pool_ready = True
+
+
+@contextmanager
+def writer():
+    """Borrow the single writer connection; commits on success, rolls back on error."""
+    if not _pool_ready:
+        _init_pool()
+    with _writer_lock:
+        with _writer_conn:
+            yield _writer_conn
+
+
+@contextmanager
+def reader():
+    """Borrow a read-only connection from the pool, replacing it if it breaks."""
+    if not _pool_ready:
+        _init_pool()
+    conn = _POOL.get()
+    try:
+        yield conn
+    except sqlite3.Error:
+        conn.close()
+        conn = connect_db(read_only=True)
+        raise
+    finally:
+        _POOL.put(conn)
+# -------------------------------------------------------
 
 
 def init_db():
-    with connect_db() as conn:
+    with writer() as conn:
         conn.execute('''
             CREATE TABLE IF NOT EXISTS print_jobs (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -55,53 +143,66 @@ def init_db():
                 status TEXT CHECK(status IN ('pending','processing','done','failed')) DEFAULT 'pending',
                 retries INTEGER DEFAULT 0,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                meta TEXT
+                meta BLOB
             )
         ''')
+        # Serves the dequeue seek, the GROUP BY status counts (covering)
+        # and the retention cleanup range scan
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_jobs_status_created
+            ON print_jobs(status, created_at)
+        ''')
+        # Jobs claimed by a previous run were never printed; hand them back
+        conn.execute("UPDATE print_jobs SET status='pending' WHERE status='processing'")
 
 
 def add_to_queue(label: str, content: str, meta: dict):
-    with connect_db() as conn:
-        conn.execute(
+    add_many_to_queue([(label, content, orjson.dumps(meta))])
+    logging.info("Enqueued new job: %s", label)
+
+
+def add_many_to_queue(rows: list):
+    """Insert (label, content, meta_json_bytes) rows in one transaction."""
+    with writer() as conn:
+        conn.executemany(
             "INSERT INTO print_jobs (label, content, meta) VALUES (?, ?, ?)",
-            (label, content, json.dumps(meta))
+            rows
         )
-    logging.info("Enqueued new job: %s", label)
+    with _job_cv:
+        _job_cv.notify()
 
 
-def get_and_mark_job_processing():
-    with connect_db() as conn:
-        conn.isolation_level = None
-        cur = conn.cursor()
-        try:
-            cur.execute("BEGIN EXCLUSIVE")
-            cur.execute(
-                "SELECT id, label, content, meta, retries FROM print_jobs WHERE status='pending' ORDER BY created_at ASC LIMIT 1"
-            )
-            job = cur.fetchone()
-            if not job:
-                cur.execute("COMMIT")
-                return None
-            job_id = job[0]
-            cur.execute(
-                "UPDATE print_jobs SET status='processing' WHERE id=?", (job_id,)
-            )
-            cur.execute("COMMIT")
-            return job
-        except Exception as e:
-            logging.error(f"DB error grabbing job: {e}")
-            cur.execute("ROLLBACK")
-            return None
+def claim_jobs(limit: int):
+    """Mark up to `limit` of the oldest pending jobs as processing and return them."""
+    try:
+        with writer() as conn:
+            jobs = conn.execute(
+                """
+                UPDATE print_jobs SET status='processing'
+                WHERE id IN (
+                    SELECT id FROM print_jobs WHERE status='pending'
+                    ORDER BY created_at ASC LIMIT ?
+                )
+                RETURNING id, label, content, meta, retries
+                """,
+                (limit,)
+            ).fetchall()
+    except Exception as e:
+        logging.error(f"DB error grabbing jobs: {e}")
+        return []
+    # RETURNING order is unspecified; ids follow insertion order
+    jobs.sort(key=lambda job: job[0])
+    return jobs
 
 
 def mark_job_done(job_id: int):
-    with connect_db() as conn:
+    with writer() as conn:
         conn.execute("UPDATE print_jobs SET status='done' WHERE id=?", (job_id,))
     logging.info(f"Job {job_id} completed.")
 
 
 def mark_job_failed(job_id: int, retries: int):
-    with connect_db() as conn:
+    with writer() as conn:
         if retries + 1 >= MAX_RETRIES:
             conn.execute(
                 "UPDATE print_jobs SET status='failed', retries=? WHERE id=?",
@@ -116,21 +217,118 @@ def mark_job_failed(job_id: int, retries: int):
             logging.warning(f"Job {job_id} failed, will retry ({retries+1}/{MAX_RETRIES}).")
 
 
+def delete_expired_jobs():
+    with writer() as conn:
+        # created_at is CURRENT_TIMESTAMP (UTC), so compare against SQLite's clock
+        conn.execute("BEGIN IMMEDIATE")
+        cur = conn.execute(
+            "DELETE FROM print_jobs WHERE status IN ('done','failed') AND created_at < datetime('now', ?)",
+            (f"-{JOB_RETENTION_DAYS} days",)
+        )
+    return cur.rowcount
+
+
 def cleanup_jobs():
-    while True:
-        threshold = datetime.now() - timedelta(days=JOB_RETENTION_DAYS)
-        with connect_db() as conn:
-            conn.execute(
-                "DELETE FROM print_jobs WHERE (status='done' OR status='failed') AND created_at < ?",
-                (threshold,)
-            )
-        time.sleep(24 * 3600)
+    while not _shutdown.is_set():
+        delete_expired_jobs()
+        # Returns early when stop_services() sets the flag
+        _shutdown.wait(24 * 3600)
+
+
+# --- Printer cache: one shared connection per device, used by one worker at a time ---
+_printers = {}
+_printer_locks = {}
+_printers_guard = threading.Lock()
+
+
+def printer_lock(key):
+    with _printers_guard:
+        lock = _printer_locks.get(key)
+        if lock is None:
+            lock = _printer_locks[key] = threading.Lock()
+        return lock
+
+
+def _open_printer(key):
+    vendor_id, product_id = key
+    _printers[key] = Usb(vendor_id, product_id, timeout=USB_WRITE_TIMEOUT_MS)
+    return _printers[key]
+
+
+def close_printer(key):
+    printer = _printers.pop(key, None)
+    if printer is not None:
+        try:
+            printer.close()
+        except Exception as e:
+            logging.warning(f"Error closing printer: {e}")
+
+
+def send_to_printer(key, payload):
+    """Write payload to the cached printer for key, opening it if needed.
+
+    Callers must hold printer_lock(key). On a write error the printer is
+    closed so the next attempt reconnects; the payload is not resent here
+    because part of it may already have printed.
+    """
+    printer = _printers.get(key)
+    if printer is None:
+        printer = _open_printer(key)
+    try:
+        printer._raw(payload)
+    except Exception:
+        close_printer(key)
+        raise
+# -------------------------------------------------------
+
+
+# --- Precomputed ESC/POS text style commands ---
+def _style_bytes(**kwargs):
+    dummy = Dummy()
+    dummy.set(**kwargs)
+    return dummy.output
+
+# python-escpos 3.x ignores width/height without custom_size, so use the
+# double/normal text size flags
+SET_LABEL_BIG = _style_bytes(align='center', double_width=True, double_height=True)
+SET_LABEL_SMALL = _style_bytes(align='center', normal_textsize=True)
+# -------------------------------------------------------
+
+
+@lru_cache(maxsize=256)
+def render_copy(label, content, barcode_width, barcode_height, dots):
+    """Render one label (text, barcode, feed, cut) to ESC/POS bytes.
+
+    Cached, so reprinting the same label skips python-escpos entirely.
+    """
+    dummy = Dummy()
+    if label:
+        dummy._raw(SET_LABEL_BIG)
+        dummy.text(label + "\n")
+        dummy._raw(SET_LABEL_SMALL)
+    # barcode() centers itself (align_ct), so no separate align command
+    # CODE128 needs an explicit code set prefix; default to set B (full ASCII)
+    if not content.startswith('{'):
+        content = '{B' + content
+    dummy.barcode(
+        content,
+        'CODE128',
+        function_type='B',
+        pos='BELOW',
+        width=barcode_width,
+        height=barcode_height
+    )
+    # ESC J takes a single byte, so feeds over 255 dots are split
+    for offset in range(0, dots, 255):
+        dummy._raw(bytes((0x1b, 0x4a, min(dots - offset, 255))))
+    dummy.cut()
+    return dummy.output
 
 
 def print_job(job):
     job_id, label, content, meta_json, retries = job
     try:
-        meta = json.loads(meta_json or '{}')
+        meta = orjson.loads(meta_json or b'{}')
         quantity = int(meta.get('quantity', 1))
 
         # Helper: parse USB IDs with automatic base detection
@@ -143,31 +341,19 @@ def print_job(job):
         vendor_id = parse_id(meta.get('usb_vendor_id'), DEFAULT_USB_VENDOR_ID)
         product_id = parse_id(meta.get('usb_product_id'), DEFAULT_USB_PRODUCT_ID)
         logging.info(f"Using USB IDs: vendor={hex(vendor_id)}, product={hex(product_id)}")
-        printer = Usb(vendor_id, product_id, timeout=10)
-
-        printer.barcode("{B012ABCDabcd", "CODE128", function_type="B")
-        printer.cut()
-
-        for _ in range(quantity):
-            if label:
-                printer.set(align='center', width=2, height=2)
-                printer.text(label + "\n")
-                printer.set(align='center', width=1, height=1)
-            printer.set(align='center')
-            barcode_width = int(meta.get('barcode_width', DEFAULT_BARCODE_WIDTH))
-            barcode_height = int(meta.get('barcode_height', DEFAULT_BARCODE_HEIGHT))
-            printer.barcode(
-                content,
-                'CODE128',
-                function_type='A',
-                position='below',
-                width=barcode_width,
-                height=barcode_height
-            )
-            label_height_mm = float(meta.get('height', 40))
-            dots = int(label_height_mm / 0.125)
-            printer._raw(bytes([0x1b, 0x4a, dots]))
-            printer.cut()
+        key = (vendor_id, product_id)
+
+        barcode_width = int(meta.get('barcode_width', DEFAULT_BARCODE_WIDTH))
+        barcode_height = int(meta.get('barcode_height', DEFAULT_BARCODE_HEIGHT))
+        label_height_mm = float(meta.get('height', 40))
+        dots = int(label_height_mm / 0.125)
+
+        # Send copies in chunks of COPIES_PER_WRITE rather than one write per
+        # command, so no single write has to cover a whole bulk job
+        payload = render_copy(label, content, barcode_width, barcode_height, dots)
+        with printer_lock(key):
+            for sent in range(0, quantity, COPIES_PER_WRITE):
+                send_to_printer(key, payload * min(COPIES_PER_WRITE, quantity - sent))
 
         mark_job_done(job_id)
     except Exception as e:
@@ -176,16 +362,34 @@ def print_job(job):
         time.sleep(5)
 
 
+def dispatcher_loop():
+    while not _shutdown.is_set():
+        # Claim under the condition lock so a notify cannot slip in between
+        # an empty claim and the wait
+        with _job_cv:
+            free = _in_flight.maxsize - _in_flight.qsize()
+            jobs = claim_jobs(free) if free > 0 else []
+            if not jobs:
+                _job_cv.wait(timeout=JOB_WAIT_TIMEOUT)
+                continue
+        # Only the dispatcher puts, so these never block
+        for job in jobs:
+            _in_flight.put(job)
+
+
 def worker_loop():
     while True:
-        job = get_and_mark_job_processing()
-        if job:
-            print_job(job)
-        else:
-            time.sleep(1)
+        job = _in_flight.get()
+        if job is None:
+            break
+        with _job_cv:
+            _job_cv.notify()  # a prefetch slot is free again
+        print_job(job)
 
 
 def start_services():
+    dt = threading.Thread(target=dispatcher_loop, daemon=True, name="Dispatcher")
+    dt.start()
     for i in range(WORKER_COUNT):
         t = threading.Thread(target=worker_loop, daemon=True, name=f"Worker-{i+1}")
         t.start()
@@ -193,10 +397,38 @@ def start_services():
     ct = threading.Thread(target=cleanup_jobs, daemon=True, name="Cleanup")
     ct.start()
     logging.info("Started daily cleanup thread.")
+    atexit.register(stop_services)
+
+
+def stop_services():
+    _shutdown.set()
+    with _job_cv:
+        _job_cv.notify_all()
+    # Unclaimed prefetched jobs are reset to pending by init_db on next start
+    for _ in range(WORKER_COUNT):
+        try:
+            _in_flight.put_nowait(None)
+        except queue.Full:
+            break
 
 @app.route('/print/barcodes', methods=['POST'])
 def enqueue_print():
     data = request.get_json() or {}
+    if isinstance(data, list):
+        # Bulk run: validate every job, then insert them all at once
+        rows = []
+        for item in data:
+            if not isinstance(item, dict) or not item.get('content'):
+                return jsonify({'error': 'Missing content field.'}), 400
+            rows.append((item.get('label', ''), item['content'], orjson.dumps(item.get('meta', {}))))
+        try:
+            add_many_to_queue(rows)
+            logging.info(f"Enqueued {len(rows)} jobs.")
+            return jsonify({'message': f'{len(rows)} print jobs queued.'})
+        except Exception as e:
+            logging.error(f"Enqueue error: {e}")
+            return jsonify({'error': str(e)}), 500
+
     label = data.get('label', '')
     content = data.get('content')
     meta = data.get('meta', {})
@@ -209,28 +441,40 @@ def enqueue_print():
         logging.error(f"Enqueue error: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/admin/cleanup', methods=['POST'])
+def run_cleanup():
+    try:
+        deleted = delete_expired_jobs()
+        logging.info(f"Manual cleanup removed {deleted} jobs.")
+        return jsonify({'message': 'Cleanup complete.', 'deleted_jobs': deleted})
+    except Exception as e:
+        logging.error(f"Cleanup error: {e}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/status/print-barcodes', methods=['GET'])
 def queue_status():
-    with connect_db() as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT COUNT(*) FROM print_jobs WHERE status='pending'")
-        pending = cur.fetchone()[0]
-        cur.execute("SELECT COUNT(*) FROM print_jobs WHERE status='processing'")
-        processing = cur.fetchone()[0]
-        cur.execute("SELECT COUNT(*) FROM print_jobs WHERE status='failed'")
-        failed = cur.fetchone()[0]
-    return jsonify({
+    with reader() as conn:
+        cur = conn.execute("SELECT status, COUNT(*) FROM print_jobs GROUP BY status")
+        counts = {row[0]: row[1] for row in cur.fetchall()}
+    pending = counts.get('pending', 0)
+    processing = counts.get('processing', 0)
+    failed = counts.get('failed', 0)
+    response = jsonify({
         'pending_jobs': pending,
         'processing_jobs': processing,
         'failed_jobs': failed
     })
+    # Let pollers and proxies reuse the answer briefly, and get a 304 when unchanged
+    response.headers['Cache-Control'] = 'public, max-age=1'
+    response.set_etag(f"{pending}-{processing}-{failed}")
+    return response.make_conditional(request)
 
 if __name__ == '__main__':
     init_db()
     start_services()
-    app.run(
-        host='0.0.0.0',
-        port=8000,
-        threaded=True,
-        ssl_context=('./certs/cert.pem', './certs/cert.key')
-    )
+    server = WSGIServer((HTTP_HOST, HTTP_PORT), app, numthreads=HTTP_THREADS)
+    server.ssl_adapter = BuiltinSSLAdapter(SSL_CERT, SSL_KEY)
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        server.stop()
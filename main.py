@@ -1,7 +1,10 @@
+from functools import lru_cache
+
 import usb.core, usb.util
 
 VENDOR_ID = 0x0fe6
 PRODUCT_ID = 0x8800
+WRITE_TIMEOUT_MS = 2000
 
 printer = usb.core.find(idVendor=VENDOR_ID, idProduct=PRODUCT_ID)
 if printer is None:
@@ -10,8 +13,12 @@ if printer is None:
 if printer.is_kernel_driver_active(0):
     printer.detach_kernel_driver(0)
 
-printer.set_configuration()
-cfg = printer.get_active_configuration()
+# set_configuration resets the device, so only run it when unconfigured
+try:
+    cfg = printer.get_active_configuration()
+except usb.core.USBError:
+    printer.set_configuration()
+    cfg = printer.get_active_configuration()
 intf = cfg[(0, 0)]
 
 ep_out = usb.util.find_descriptor(
@@ -22,18 +29,27 @@ if ep_out is None:
     raise ValueError("No USB OUT endpoint found.")
 
 # ——— Minimal TSPL (no HOME, no extra resets) ———
-label = (
+LABEL_TEMPLATE = (
     # 1) Define size and gap
-    "SIZE 45 mm, 35 mm\r\n" +
-	"GAP 2 mm, 0 mm\r\n" +
-	"DIRECTION 1\r\n" +
-	"CLS\r\n" +
-	"SET PRINTER DT\r\n" +
-	"TEXT 10,10,\"3\",0,1,1,\"PRICE: 20000\"\r\n" +
-	"BARCODE 10,50,\"128\",50,1,0,2,2,\"W12345678\"\r\n" +
-	"PRINT 1,1\r\n" +
-	"CUT\r\n"
+    "SIZE 45 mm, 35 mm\r\n"
+    "GAP 2 mm, 0 mm\r\n"
+    "DIRECTION 1\r\n"
+    "CLS\r\n"
+    "SET PRINTER DT\r\n"
+    "TEXT 10,10,\"3\",0,1,1,\"PRICE: {price}\"\r\n"
+    "BARCODE 10,50,\"128\",50,1,0,2,2,\"{code}\"\r\n"
+    "PRINT 1,1\r\n"
+    "CUT\r\n"
 )
 
-ep_out.write(label.encode("ascii"))
+
+@lru_cache(maxsize=256)
+def build_label(price, code):
+    return LABEL_TEMPLATE.format(price=price, code=code).encode("ascii")
+
+
+# Queue up labels and send them in one bulk transfer
+labels = [build_label(20000, "W12345678")]
+write = ep_out.write
+write(b"".join(labels), timeout=WRITE_TIMEOUT_MS)
 print("✅ Label sent")